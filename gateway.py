@@ -3,34 +3,517 @@
 Papermill Gateway - Flask API for executing Jupyter notebooks via Papermill
 """
 from flask import Flask, request, send_file, jsonify
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import papermill as pm
+from papermill.clientwrap import PapermillNotebookClient
+from papermill.engines import NBClientEngine, papermill_engines
+from papermill.execute import prepare_notebook_metadata, raise_for_execution_errors, remove_error_markers
+from papermill.log import logger as papermill_logger
+from papermill.utils import merge_kwargs, remove_args
+from jupyter_client.manager import AsyncKernelManager
+from jupyter_core.utils import run_sync
 import nbformat
-import tempfile, os, traceback
-import json
-from pathlib import Path
+import os, sys, traceback
+import io
+import ast
+import importlib.metadata
+import importlib.util
+import re
 import http
 import time
+import hashlib
+import sqlite3
+from functools import singledispatch
+import threading
+import uuid
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional dependencies: imported once here (before gunicorn forks), never per request
+try:
+    import numpy as np
+    import pandas as pd
+    _HAS_PANDAS = True
+except ImportError:  # only needed to serialise DataFrame/ndarray scraps
+    _HAS_PANDAS = False
+try:
+    import pyarrow as pa
+    _HAS_PYARROW = True
+except ImportError:  # mixed-dtype DataFrames go through pandas' formatter instead
+    _HAS_PYARROW = False
+try:
+    from scrapbook.encoders import registry as scrap_encoders
+    from scrapbook.scraps import Scrap
+    _HAS_SCRAPBOOK = True
+except ImportError:  # JSON/text scraps are decoded without it
+    _HAS_SCRAPBOOK = False
+try:
+    import diskcache
+    _HAS_DISKCACHE = True
+except ImportError:  # results are cached per process instead
+    _HAS_DISKCACHE = False
+try:
+    import psutil
+    _HAS_PSUTIL = True
+except ImportError:  # /metrics reports null usage figures
+    _HAS_PSUTIL = False
+try:
+    from flask_compress import Compress
+    _HAS_COMPRESS = True
+except ImportError:  # responses are sent uncompressed
+    _HAS_COMPRESS = False
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (native NumPy/datetime support)."""
+
+    def dumps_bytes(self, obj) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self.dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 start_time = time.time()  # Track service start time
 
 # Configuration
-app.config["MAX_CONTENT_LENGTH"] = 5 * 1024 * 1024  # Global 5MB limit
 MAX_NOTEBOOK_SIZE_MB = 5
+app.config["MAX_CONTENT_LENGTH"] = MAX_NOTEBOOK_SIZE_MB * 1024 * 1024  # Global 5MB limit
+app.config["MAX_FORM_MEMORY_SIZE"] = app.config["MAX_CONTENT_LENGTH"]
+
+# Compress JSON responses (results often carry base64 images / large frames); SSE is
+# left alone
+app.config["COMPRESS_ALGORITHM"] = ["zstd", "br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+if _HAS_COMPRESS:
+    Compress(app)
+
+class BodyLimit:
+    """
+    WSGI guard that answers 413 before Flask reads or parses an oversized body.
+    A declared Content-Length is checked up front; chunked bodies (no length)
+    are read up to `limit + 1` bytes and handed on as a sized, buffered stream.
+    The server may still read and discard the rest of a rejected upload; cap raw
+    request bodies at the reverse proxy if that matters.
+    """
+
+    def __init__(self, wsgi_app, limit: int):
+        self.wsgi_app = wsgi_app
+        self.limit = limit
+
+    def _too_large(self, start_response):
+        body = b'{"error":"Notebook too large"}'
+        start_response("413 Request Entity Too Large", [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+        ])
+        return [body]
+
+    def __call__(self, environ, start_response):
+        length = environ.get("CONTENT_LENGTH")
+        if length:
+            if not length.isdigit() or int(length) > self.limit:
+                return self._too_large(start_response)
+        elif "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            body = environ["wsgi.input"].read(self.limit + 1)
+            if len(body) > self.limit:
+                return self._too_large(start_response)
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+            environ.pop("HTTP_TRANSFER_ENCODING")
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = BodyLimit(app.wsgi_app, app.config["MAX_CONTENT_LENGTH"])
+
 ALLOWED_KERNELS = {"python3", "python"}  # whitelist
 RESULT_TAG = "results"  # keep lowercase, papermill lower-cases tags
 USE_SCRAPBOOK = True    # glue is safer for data frames
-EXECUTION_TIMEOUT = 300  # 5 minutes max execution time
+SSE_KEEPALIVE = 15  # seconds between keep-alive comments on /run/stream
+DEBUG = os.environ.get("DEBUG") == "1"  # include tracebacks in kernel errors
+EXECUTION_TIMEOUT = int(os.environ.get("EXECUTION_TIMEOUT", 300))  # 5 minutes max execution time
+GATEWAY_VERSION = "1.3"  # bump when the shape of `results` or cache entries changes; part of every cache key
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 128))  # in-process entries, 0 disables caching
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/var/cache/papermill")  # shared by all workers
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 86400))  # seconds
+KERNEL_POOL = int(os.environ.get("KERNEL_POOL", 2))  # warm kernels per kernelspec, 0 disables
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 32))  # notebooks per /run/batch request
+KERNEL_RETRY_MAX = 60  # seconds, upper bound of the backoff between failed kernel starts
+
+DIRECT_ENGINE = os.environ.get("DIRECT_ENGINE", "true").lower() != "false"  # false: pm.execute_notebook
+
+# Entries are only valid for the gateway/papermill/Python combination that produced them
+_CACHE_NAMESPACE = (f"{GATEWAY_VERSION}:{pm.__version__}:"
+                    f"{sys.version_info.major}.{sys.version_info.minor}")
+
+def _open_disk_cache():
+    """
+    Shared on-disk (results, hit/miss counters) caches, or (None, None) to fall
+    back to the in-process LRU.
+    """
+    if not _HAS_DISKCACHE or RESULT_CACHE_SIZE <= 0:
+        return None, None
+    try:
+        cache = diskcache.Cache(RESULT_CACHE_DIR, size_limit=2**30)
+        counters = diskcache.Cache(os.path.join(RESULT_CACHE_DIR, "stats"))
+        # probe with real writes: an existing read-only directory opens without error
+        probe = f"probe:{os.getpid()}"
+        cache.set(probe, b"")
+        cache.delete(probe)
+        counters.add("hits", 0)
+        counters.add("misses", 0)
+        # reconnect lazily, so forked workers never share a SQLite handle
+        cache.close()
+        counters.close()
+        return cache, counters
+    except (OSError, sqlite3.Error):
+        app.logger.warning("Result cache directory %s is not usable; caching in process",
+                           RESULT_CACHE_DIR, exc_info=True)
+        return None, None
+
+_disk_cache, _disk_cache_stats = _open_disk_cache()
+
+# Fallback: (expiry, etag, encoded results) of successful runs in this process only (LRU order)
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+_result_cache_stats = {"hits": 0, "misses": 0}
+
+def _payload_key(nb_json: dict, kernelspec: str) -> str:
+    """SHA-256 of the canonicalised notebook JSON plus the kernel it runs on."""
+    canonical = orjson.dumps(nb_json, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(kernelspec.encode() + b"\0" + canonical).hexdigest()
+
+def _code_key(nb_node, kernelspec: str) -> str:
+    """
+    SHA-256 over only what execution depends on: the kernel and the code cells
+    with their tags (nbclient honours `skip-execution` / `raises-exception`,
+    and tag-based result collection reads them).  Markdown edits, cell ids and
+    stale outputs leave it unchanged.
+    """
+    h = hashlib.sha256(kernelspec.encode())
+    for cell in nb_node.cells:
+        if cell.cell_type == "code":
+            h.update(b"\0" + cell.source.encode())
+            tags = cell.metadata.get("tags", []) + cell.metadata.get("papermill", {}).get("tags", [])
+            h.update(b"\0" + "\0".join(tags).encode())
+    return h.hexdigest()
+
+def _cache_get(key: str):
+    """Return (encoded results, their ETag) for `key`, or None on a miss."""
+    key = f"{key}:{_CACHE_NAMESPACE}"
+    if _disk_cache is not None:
+        try:
+            return _disk_cache.get(key)
+        except Exception:  # locked / corrupt database: run the notebook instead
+            app.logger.warning("Result cache read failed; treating as a miss", exc_info=True)
+            return None
+    with _result_cache_lock:
+        expires, etag, blob = _result_cache.get(key, (0, None, None))
+        if time.monotonic() >= expires:
+            _result_cache.pop(key, None)
+            return None
+        _result_cache.move_to_end(key)
+        return blob, etag
+
+def _cache_set(results: dict, *keys: str):
+    """
+    Encode results once and store them under each of `keys`, evicting least
+    recently used entries (expired ones are dropped on lookup).  Returns
+    (encoded results, ETag); the ETag hashes the encoding, so it changes
+    whenever the content does.
+    """
+    blob = app.json.dumps_bytes(results)
+    etag = hashlib.sha256(blob).hexdigest()
+    if RESULT_CACHE_SIZE <= 0:
+        return blob, etag
+    for key in keys:
+        key = f"{key}:{_CACHE_NAMESPACE}"
+        if _disk_cache is not None:
+            try:
+                _disk_cache.set(key, (blob, etag), expire=RESULT_CACHE_TTL)
+            except Exception:  # the results are still returned, just not cached
+                app.logger.warning("Result cache write failed; not caching", exc_info=True)
+                break
+            continue
+        with _result_cache_lock:
+            _result_cache[key] = (time.monotonic() + RESULT_CACHE_TTL, etag, blob)
+            _result_cache.move_to_end(key)
+            while len(_result_cache) > RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
+    return blob, etag
+
+def _cache_count(hit: bool) -> None:
+    """Record one lookup outcome per request (not per key tried)."""
+    name = "hits" if hit else "misses"
+    if _disk_cache is not None:
+        try:
+            _disk_cache_stats.incr(name)
+        except Exception:
+            app.logger.warning("Result cache counter update failed", exc_info=True)
+        return
+    with _result_cache_lock:
+        _result_cache_stats[name] += 1
+
+def _cache_backend() -> str:
+    if RESULT_CACHE_SIZE <= 0:
+        return "disabled"
+    return "disk" if _disk_cache is not None else "memory"
+
+def _cache_stats() -> dict:
+    if _disk_cache is not None:
+        return {"backend": "disk", "directory": RESULT_CACHE_DIR, "entries": len(_disk_cache),
+                "size_bytes": _disk_cache.volume(),
+                "hits": _disk_cache_stats.get("hits", 0),
+                "misses": _disk_cache_stats.get("misses", 0)}
+    now = time.monotonic()
+    with _result_cache_lock:
+        entries = sum(expires > now for expires, _, _ in _result_cache.values())
+        return {"backend": _cache_backend(), "entries": entries, **_result_cache_stats}
+
+class _KernelPool:
+    """
+    Kernels started ahead of time for one kernelspec.  Each runs exactly one
+    notebook: module state, cwd and environment variables would otherwise leak
+    to the next caller, so used kernels are shut down and replaced, off the
+    request path.
+    """
 
-def _extract_results(nb_path: str) -> dict:
+    def __init__(self, kernel_name: str, size: int):
+        self.kernel_name = kernel_name
+        self.size = size
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._spawn(self._refill)
+
+    def _spawn(self, target, *args) -> None:
+        threading.Thread(target=target, args=args, daemon=True,
+                         name=f"kernel-pool-{self.kernel_name}").start()
+
+    def _start(self) -> AsyncKernelManager:
+        km = AsyncKernelManager(kernel_name=self.kernel_name)
+        run_sync(km.start_kernel)()
+        return km
+
+    def _refill(self) -> None:
+        """Start one fresh kernel, retrying with backoff so the pool never shrinks for good."""
+        delay = 1
+        while True:
+            try:
+                self._idle.put(self._start())
+                return
+            except Exception:
+                app.logger.exception("Could not start '%s' kernel; retrying in %ss",
+                                     self.kernel_name, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, KERNEL_RETRY_MAX)
+
+    def _replace(self, km: AsyncKernelManager) -> None:
+        try:
+            run_sync(km.shutdown_kernel)(now=True)
+        except Exception:
+            app.logger.exception("Could not shut down used '%s' kernel", self.kernel_name)
+        self._refill()
+
+    def checkout(self) -> AsyncKernelManager:
+        try:
+            return self._idle.get(timeout=EXECUTION_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(f"No '{self.kernel_name}' kernel free within {EXECUTION_TIMEOUT}s")
+
+    def checkin(self, km: AsyncKernelManager) -> None:
+        """Retire a used kernel and start its replacement in the background."""
+        self._spawn(self._replace, km)
+
+_kernel_pools = {}
+_kernel_pools_lock = threading.Lock()
+
+def _kernel_pool(kernel_name: str) -> _KernelPool:
+    """Return the pool for `kernel_name`, creating it on first use; kernels start in the background."""
+    with _kernel_pools_lock:
+        if kernel_name not in _kernel_pools:
+            _kernel_pools[kernel_name] = _KernelPool(kernel_name, KERNEL_POOL)
+        return _kernel_pools[kernel_name]
+
+class PooledEngine(NBClientEngine):
+    """nbclient engine that borrows a warm kernel instead of starting one per run."""
+
+    @classmethod
+    def execute_managed_notebook(cls, nb_man, kernel_name, log_output=False, stdout_file=None,
+                                 stderr_file=None, start_timeout=60, execution_timeout=None, **kwargs):
+        kwargs = remove_args(['input_path', 'timeout', 'startup_timeout', 'km'], **kwargs)
+        pool = _kernel_pool(kernel_name)
+        km = pool.checkout()
+        client = PapermillNotebookClient(nb_man, **merge_kwargs(
+            kwargs,
+            km=km,
+            timeout=execution_timeout,
+            startup_timeout=start_timeout,
+            kernel_name=kernel_name,
+            log=papermill_logger,
+            log_output=log_output,
+            stdout_file=stdout_file,
+            stderr_file=stderr_file,
+        ))
+        try:
+            return client.execute()
+        finally:
+            # nbclient leaves kernels it does not own running; we only drop the client
+            if client.kc is not None:
+                client.kc.stop_channels()
+            pool.checkin(km)
+
+papermill_engines.register("pooled", PooledEngine)
+ENGINE_NAME = "pooled" if KERNEL_POOL > 0 else None
+
+class MemoryIO:
+    """Papermill I/O handler for `memory://` paths, backed by a process-local dict."""
+
+    store = {}
+
+    def read(self, path):
+        return self.store[path]
+
+    def write(self, buf, path):
+        self.store[path] = buf
+
+    def listdir(self, path):
+        raise PermissionError("listdir is not supported for memory:// paths")
+
+    def pretty_path(self, path):
+        return path
+
+pm.iorw.papermill_io.register("memory://", MemoryIO())
+
+def _execute_notebook(nb_node, kernel_name: str, **engine_kwargs) -> None:
+    """
+    Execute `nb_node` in place.  By default the node is handed straight to the
+    Papermill engine, mirroring `pm.execute_notebook` minus its load and save;
+    with DIRECT_ENGINE off it runs the full `pm.execute_notebook` over
+    `memory://` paths instead.  Raises PapermillExecutionError either way.
+    `engine_kwargs` reach the nbclient NotebookClient (e.g. `on_cell_executed`).
+    """
+    if not DIRECT_ENGINE:
+        run_id = uuid.uuid4().hex
+        src, dst = f"memory://{run_id}/input.ipynb", f"memory://{run_id}/output.ipynb"
+        MemoryIO.store[src] = nbformat.writes(nb_node)
+        try:
+            pm.execute_notebook(
+                src,
+                dst,
+                kernel_name=kernel_name,
+                engine_name=ENGINE_NAME,
+                request_save_on_cell_execute=False,  # one write at the end (or on error)
+                progress_bar=False,
+                log_output=False,
+                start_timeout=60,  # Don't wait forever for kernel start
+                execution_timeout=EXECUTION_TIMEOUT,  # Max execution time
+                **engine_kwargs
+            )
+        finally:
+            MemoryIO.store.pop(src, None)
+            output = MemoryIO.store.pop(dst, None)
+            if output is not None:  # papermill saves before raising
+                executed = nbformat.reads(output, as_version=4)
+                nb_node.cells, nb_node.metadata = executed.cells, executed.metadata
+        return
+
+    # the same preparation papermill's load_notebook_node applies
+    nbformat.v4.upgrade(nb_node)
+    if "papermill" not in nb_node.metadata:
+        nb_node.metadata["papermill"] = {
+            "default_parameters": {},
+            "parameters": {},
+            "environment_variables": {},
+            "version": pm.__version__,
+        }
+    for cell in nb_node.cells:
+        if "tags" not in cell.metadata:
+            cell.metadata["tags"] = []
+        if "papermill" not in cell.metadata:
+            cell.metadata["papermill"] = {}
+
+    prepare_notebook_metadata(nb_node, None, None)
+    remove_error_markers(nb_node)
+    papermill_engines.execute_notebook_with_engine(
+        ENGINE_NAME,
+        nb_node,
+        kernel_name=kernel_name,
+        output_path=None,  # nothing is saved while cells run
+        progress_bar=False,
+        log_output=False,
+        start_timeout=60,  # Don't wait forever for kernel start
+        execution_timeout=EXECUTION_TIMEOUT,  # Max execution time
+        **engine_kwargs
+    )
+    raise_for_execution_errors(nb_node, None)
+
+def _results_response(blob: bytes, headers: dict):
+    """`{"results": ...}` around already-encoded results (the bytes the ETag hashes)."""
+    return app.response_class(b'{"results":' + blob + b"}",
+                              mimetype="application/json", headers=headers)
+
+GLUE_MIME_PREFIX = "application/scrapbook.scrap."     # sb.glue: {name, data, encoder, version}
+RECORD_MIME_PREFIX = "application/papermill.record+"  # legacy pm.record: {name: data}
+
+def _decode_scrap(name: str, data, encoder: str):
+    """Decode one scrap payload; JSON/text inline, anything else via scrapbook's encoders."""
+    if encoder == "json":
+        if isinstance(data, str):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass  # a plain string, not JSON text
+        return data
+    if encoder == "text":
+        return data if isinstance(data, str) else str(data)
+    if not _HAS_SCRAPBOOK:
+        raise ValueError(f"Scrap '{name}' uses the '{encoder}' encoder, which needs scrapbook")
+    return scrap_encoders[encoder].decode(Scrap(name, data, encoder, None)).data
+
+def _read_scraps(nb) -> dict:
+    """
+    Scraps glued in an executed notebook, read straight off the in-memory
+    NotebookNode without scrapbook's per-scrap schema validation.  Matches
+    `sb.read_notebook(nb).scraps`, except that `glue(..., display=True)` keeps
+    its data instead of being overwritten by the display; display-only scraps
+    map to None.
+    """
+    scraps = {}
+    for cell in nb.cells:
+        for output in cell.get("outputs", []):
+            for mime, payload in output.get("data", {}).items():
+                if mime.startswith(GLUE_MIME_PREFIX):
+                    name = payload["name"]
+                    scraps[name] = _decode_scrap(name, payload.get("data"), payload["encoder"])
+                elif mime.startswith(RECORD_MIME_PREFIX):
+                    for name, data in payload.items():  # first key is the only payload
+                        scraps[name] = _decode_scrap(name, data, mime[len(RECORD_MIME_PREFIX):])
+                        break
+            # display-only scraps carry their name in the output metadata
+            metadata = output.get("metadata", {})
+            if "papermill" in metadata:
+                name = metadata["papermill"].get("name")
+            elif metadata.get("scrapbook", {}).get("display"):
+                name = metadata["scrapbook"].get("name")
+            else:
+                name = None
+            if name:
+                scraps.setdefault(name, None)
+    return scraps
+
+def _extract_results(nb) -> dict:
     """Return a clean JSON-serialisable dict of glued scraps OR fallback tag scan."""
     if USE_SCRAPBOOK:
-        import scrapbook as sb
-        book = sb.read_notebook(nb_path)  # ⇢ Scrapbook.Notebook
-        return {k: _jsonify(v.data) for k, v in book.scraps.items()}
+        return {k: _jsonify(v) for k, v in _read_scraps(nb).items()}
     else:
         out = {}
-        nb = nbformat.read(nb_path, as_version=4)
         for c in nb.cells:
             # Check both locations for tags
             tags = c.metadata.get("tags", [])
@@ -44,49 +527,130 @@ def _extract_results(nb_path: str) -> dict:
                         out[key] = _jsonify(o["data"])
         return out
 
+@singledispatch
 def _jsonify(payload):
     """Make pandas/NumPy types JSON friendly."""
-    import pandas as pd
-    import numpy as np
-    import json
-    
-    if isinstance(payload, pd.DataFrame):
-        return json.loads(payload.to_json(orient="split", date_format="iso"))
-    if isinstance(payload, (pd.Series, np.generic)):
-        return payload.tolist()
-    if isinstance(payload, dict):
-        return {k: _jsonify(v) for k, v in payload.items()}
-    if isinstance(payload, (list, tuple)):
-        return [_jsonify(item) for item in payload]
-    # Handle numpy arrays
+    # Handle other array-likes (pandas Index, Categorical, ...)
     if hasattr(payload, 'tolist'):
         return payload.tolist()
     return payload
 
+@_jsonify.register(str)
+@_jsonify.register(int)
+@_jsonify.register(float)
+@_jsonify.register(type(None))
+def _jsonify_scalar(payload):
+    return payload
+
+if _HAS_PANDAS:
+    # ndarray dtypes orjson serialises natively (OPT_SERIALIZE_NUMPY)
+    _ORJSON_DTYPES = frozenset(map(np.dtype, (bool, np.int8, np.int16, np.int32, np.int64,
+                                              np.uint8, np.uint16, np.uint32, np.uint64,
+                                              np.float32, np.float64)))
+
+    def _frame_rows(frame):
+        """Row-major cell values of `frame`, or None if only pandas can format them."""
+        if frame.shape[1] == 0:
+            return None
+        dtypes = set(frame.dtypes)
+        if len(dtypes) == 1 and dtypes <= _ORJSON_DTYPES:
+            # one homogeneous block: orjson walks the buffer, no per-cell Python objects
+            return np.ascontiguousarray(frame.to_numpy())
+        if not _HAS_PYARROW:
+            return None
+        try:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+        except (pa.ArrowException, ValueError):
+            return None
+        if not all(pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_boolean(t)
+                   or pa.types.is_string(t) or pa.types.is_large_string(t) or pa.types.is_null(t)
+                   for t in table.schema.types):
+            return None  # datetimes etc. keep pandas' ISO formatting
+        return list(zip(*(column.to_pylist() for column in table.columns)))
+
+    @_jsonify.register(pd.DataFrame)
+    def _jsonify_frame(payload):
+        """Split orientation ({"columns", "index", "data"}), as `to_json(orient="split")`."""
+        if (payload.columns.inferred_type in ("string", "integer")
+                and payload.index.inferred_type in ("string", "integer")):
+            rows = _frame_rows(payload)
+            if rows is not None:
+                return {"columns": payload.columns.tolist(),
+                        "index": payload.index.tolist(),
+                        "data": rows}
+        return orjson.loads(payload.to_json(orient="split", date_format="iso"))
+
+    @_jsonify.register(pd.Series)
+    @_jsonify.register(np.ndarray)
+    @_jsonify.register(np.generic)
+    def _jsonify_array(payload):
+        return payload.tolist()
+
+@_jsonify.register(dict)
+@_jsonify.register(list)
+@_jsonify.register(tuple)
+def _jsonify_container(payload):
+    """Rebuild nested dicts/lists with an explicit worklist instead of recursion."""
+    root = [None]
+    stack = [(root, 0, payload)]
+    while stack:
+        parent, key, value = stack.pop()
+        convert = _jsonify.dispatch(type(value))
+        if convert is not _jsonify_container:
+            parent[key] = convert(value)
+        elif isinstance(value, dict):
+            node = parent[key] = dict.fromkeys(value)  # keeps key order
+            stack.extend((node, k, v) for k, v in value.items())
+        else:
+            node = parent[key] = [None] * len(value)
+            stack.extend((node, i, v) for i, v in enumerate(value))
+    return root[0]
+
+# Top-level names importable at startup: stdlib + every installed distribution
+_IMPORT_RE = re.compile(r'^\s*(?:import|from)\s+([a-zA-Z_][a-zA-Z0-9_]*)', re.MULTILINE)
+_IMPORTABLE = (frozenset(importlib.metadata.packages_distributions())
+               | frozenset(sys.stdlib_module_names) | frozenset(sys.builtin_module_names))
+_INSTALLED = frozenset(d.metadata["Name"].lower() for d in importlib.metadata.distributions()
+                       if d.metadata["Name"])
+MAX_MISSING_IMPORTS = 20  # stop scanning once this many are found
+PACKAGE_MAP = {  # import name -> distribution name
+    'cv2': 'opencv-python',
+    'PIL': 'pillow',
+    'sklearn': 'scikit-learn'
+}
+
+def _cell_imports(source: str) -> list:
+    """Top-level module names imported by a cell; regex fallback for IPython syntax."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:  # magics, shell escapes, ...
+        return _IMPORT_RE.findall(source)
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module.split(".")[0])
+    return names
+
 def _check_missing_imports(nb_node) -> list:
     """Pre-scan notebook for missing imports to fail fast."""
-    import re
-    import pkg_resources
-    
-    installed_packages = {pkg.project_name.lower() for pkg in pkg_resources.working_set}
-    missing = []
-    
+    missing = {}
     for cell in nb_node.cells:
         if cell.cell_type == 'code':
-            # Simple regex to find import statements
-            imports = re.findall(r'^\s*(?:import|from)\s+([a-zA-Z_][a-zA-Z0-9_]*)', cell.source, re.MULTILINE)
-            for imp in imports:
-                # Check common package name mappings
-                package_map = {
-                    'cv2': 'opencv-python',
-                    'PIL': 'pillow',
-                    'sklearn': 'scikit-learn'
-                }
-                check_name = package_map.get(imp, imp)
-                if check_name.lower() not in installed_packages:
-                    missing.append(imp)
+            for imp in _cell_imports(cell.source):
+                if imp in _IMPORTABLE or imp in missing:
+                    continue
+                if PACKAGE_MAP.get(imp, imp).lower() in _INSTALLED:
+                    continue
+                # installed after startup?
+                if importlib.util.find_spec(imp) is not None:
+                    continue
+                missing[imp] = None
+                if len(missing) >= MAX_MISSING_IMPORTS:
+                    return list(missing)
     
-    return list(set(missing))  # deduplicate
+    return list(missing)  # deduplicated, in order of appearance
 
 @app.route('/')
 def health():
@@ -96,157 +660,396 @@ def health():
 @app.route('/metrics')
 def metrics():
     """Basic metrics endpoint for monitoring"""
-    import psutil
-    import time
-    
     return jsonify({
         'service': 'papermill-gateway',
         'uptime': time.time() - start_time,
-        'memory_usage_mb': psutil.Process().memory_info().rss / 1024 / 1024,
-        'cpu_percent': psutil.cpu_percent(interval=0.1),
+        'memory_usage_mb': psutil.Process().memory_info().rss / 1024 / 1024 if _HAS_PSUTIL else None,
+        'cpu_percent': psutil.cpu_percent(interval=0.1) if _HAS_PSUTIL else None,
         'config': {
             'max_notebook_size_mb': MAX_NOTEBOOK_SIZE_MB,
             'execution_timeout': EXECUTION_TIMEOUT,
             'use_scrapbook': USE_SCRAPBOOK,
+            'result_cache_size': RESULT_CACHE_SIZE,
+            'result_cache_backend': _cache_backend(),
+            'kernel_pool': KERNEL_POOL,
+            'max_batch_size': MAX_BATCH_SIZE,
+            'direct_engine': DIRECT_ENGINE,
+            'idle_kernels': {name: p._idle.qsize() for name, p in _kernel_pools.items()},
             'allowed_kernels': list(ALLOWED_KERNELS)
         }
     })
 
+@app.route('/cache')
+def cache_stats():
+    """Result cache backend, size and hit/miss counters"""
+    return jsonify(_cache_stats())
+
+class RequestError(Exception):
+    """A payload we refuse to run; carries the JSON error body and HTTP status."""
+
+    def __init__(self, payload: dict, status: int = 400):
+        super().__init__(payload.get("error") or payload.get("message"))
+        self.payload = payload
+        self.status = status
+
+def _check_notebook_structure(nb_json: dict) -> None:
+    """
+    Reject (RequestError 400) the malformed shapes that would otherwise surface
+    as AttributeErrors deep inside the cache keys, papermill or nbclient.
+    Deliberately looser than the full nbformat schema: kernelspec display names
+    may be missing, and code cells without outputs / execution counts get them
+    filled in by _prepare_notebook.
+    """
+    def invalid(reason: str):
+        return RequestError({"error": f"Invalid notebook JSON – {reason}"})
+
+    if nb_json.get("nbformat") != 4:
+        raise invalid("'nbformat' must be 4")
+    if not isinstance(nb_json.get("nbformat_minor"), int):
+        raise invalid("'nbformat_minor' must be an integer")
+    metadata = nb_json.get("metadata")
+    if not isinstance(metadata, dict):
+        raise invalid("'metadata' must be an object")
+    for name in ("kernelspec", "language_info"):
+        if not isinstance(metadata.get(name, {}), dict):
+            raise invalid(f"'metadata.{name}' must be an object")
+    if not isinstance(nb_json["cells"], list):
+        raise invalid("'cells' must be a list")
+    for i, cell in enumerate(nb_json["cells"]):
+        if not isinstance(cell, dict) or cell.get("cell_type") not in ("code", "markdown", "raw"):
+            raise invalid(f"cell {i} needs a 'cell_type' of code, markdown or raw")
+        source = cell.get("source")
+        if not (isinstance(source, str)
+                or isinstance(source, list) and all(isinstance(line, str) for line in source)):
+            raise invalid(f"cell {i} 'source' must be a string or a list of strings")
+        if not isinstance(cell.get("metadata"), dict):
+            raise invalid(f"cell {i} 'metadata' must be an object")
+
+def _prepare_notebook(payload):
+    """
+    Unwrap an n8n/raw payload, validate it and convert it to a NotebookNode.
+    Returns (nb_json, nb_node, kernelspec); raises RequestError otherwise.
+    """
+    # unwrap n8n list / dict wrappers
+    if isinstance(payload, list):
+        if not payload:
+            raise RequestError({"error": "Empty JSON array"})
+        payload = payload[0]
+    if not isinstance(payload, dict):
+        raise RequestError({"error": "Payload must be a JSON object"})
+    nb_json = payload.get("notebook", payload)
+
+    # validate + convert to NotebookNode
+    if not isinstance(nb_json, dict) or "cells" not in nb_json:
+        raise RequestError({"error": "Invalid notebook JSON – missing 'cells'"})
+    _check_notebook_structure(nb_json)
+        
+    try:
+        nb_node = nbformat.from_dict(nb_json)
+        # .ipynb files store multi-line strings as lists; join them as nbformat.reads does
+        nbformat.v4.rwbase.rejoin_lines(nb_node)
+        # hand-written payloads often omit these; pm.execute_notebook needs them
+        for cell in nb_node.cells:
+            if cell.cell_type == "code":
+                cell.setdefault("outputs", [])
+                cell.setdefault("execution_count", None)
+    except Exception as e:
+        raise RequestError({"error": f"Notebook JSON invalid: {e}"})
+
+    # kernel validation
+    kernelspec = (nb_node.metadata
+                        .get("kernelspec", {})
+                        .get("name", "python3"))
+    language = (nb_node.metadata
+                      .get("language_info", {})
+                      .get("name", "python"))
+    
+    if kernelspec not in ALLOWED_KERNELS:
+        raise RequestError({"error": f"Kernel '{kernelspec}' not allowed"})
+    if language not in {"python"}:
+        raise RequestError({"error": f"Language '{language}' not supported"})
+    return nb_json, nb_node, kernelspec
+
+def _cache_directives():
+    """
+    (lookup, store) for the current request.  `Cache-Control: no-cache` re-runs
+    the notebook and refreshes the cache; `no-store` also leaves it untouched.
+    """
+    cc = request.cache_control
+    return not (cc.no_cache or cc.no_store), not cc.no_store
+
+def _lookup_cache(nb_json, nb_node, kernelspec, lookup: bool = True):
+    """Return (cached encoded results or None, their ETag or None, payload key, code key)."""
+    cache_key = _payload_key(nb_json, kernelspec)
+    code_key = _code_key(nb_node, kernelspec)
+    if not lookup:
+        return None, None, cache_key, code_key
+    entry = _cache_get(cache_key)
+    if entry is None:
+        entry = _cache_get(code_key)  # only markdown / ids / outputs changed
+    if RESULT_CACHE_SIZE > 0:
+        _cache_count(entry is not None)
+    cached, etag = entry or (None, None)
+    return cached, etag, cache_key, code_key
+
+def _preflight(nb_node) -> None:
+    """Fail fast (RequestError 422) on imports that cannot be satisfied."""
+    try:
+        missing_imports = _check_missing_imports(nb_node)
+    except Exception:
+        # If import checking fails, continue anyway (don't block execution)
+        return
+    if missing_imports:
+        raise RequestError({
+            "error_type": "missing_dependencies",
+            "missing_modules": missing_imports,
+            "message": f"Missing required modules: {', '.join(missing_imports)}"
+        }, 422)
+
+def _execution_error(nb_node, ex: Exception):
+    """Map an exception raised by _execute_notebook to (error payload, HTTP status)."""
+    if isinstance(ex, pm.exceptions.PapermillExecutionError):
+        # Decide which error flavour we want to expose
+        wrapped_is_module = ex.ename == "ModuleNotFoundError"
+        
+        # Handle traceback - can be string or list
+        tb = ex.traceback or []
+        if isinstance(tb, str):
+            tb = tb.splitlines()
+        
+        err_payload = {
+            "error_type": (
+                "module_not_found" if wrapped_is_module else
+                "papermill_execution_error"
+            ),
+            "cell": ex.exec_count,
+            "cell_source": _cell_source_from_output(nb_node, ex.exec_count),
+            "ename": ex.ename,
+            "evalue": ex.evalue,
+            "traceback": tb[-15:]  # Last 15 lines, whichever form it was
+        }
+        status = (http.HTTPStatus.BAD_REQUEST      # 400
+                  if wrapped_is_module else
+                  http.HTTPStatus.UNPROCESSABLE_ENTITY)  # 422
+        return err_payload, status
+    if isinstance(ex, ModuleNotFoundError):  # catches missing libs
+        return {
+            "error_type": "module_not_found",
+            "module": getattr(ex, 'name', 'unknown'),
+            "message": str(ex)
+        }, http.HTTPStatus.BAD_REQUEST
+    err_payload = {
+        "error_type": "kernel_startup", 
+        "message": f"{type(ex).__name__}: {ex}"
+    }
+    if DEBUG:
+        trace = traceback.format_exception(type(ex), ex, ex.__traceback__, limit=-4)
+        err_payload["trace"] = "".join(trace).splitlines()[-10:]
+    return err_payload, 500
+
+def _gateway_error_payload(exc: Exception):
+    """(error payload, HTTP status) for anything that escaped the specific handlers."""
+    if isinstance(exc, RequestError):
+        return exc.payload, exc.status
+    if isinstance(exc, (ValueError, KeyError, TypeError)):  # malformed payloads, no trace needed
+        return {"error": f"Invalid request – {exc}"}, 400
+    return {
+        "error_type": "gateway_error",
+        "error": str(exc),
+        # only the innermost frames end up in the last 10 lines anyway
+        "trace": "".join(traceback.format_exception(type(exc), exc, exc.__traceback__,
+                                                    limit=-4)).splitlines()[-10:]
+    }, 500
+
+def _gateway_error(exc: Exception):
+    """Response for anything that escaped the specific handlers."""
+    err_payload, status = _gateway_error_payload(exc)
+    return jsonify(err_payload), status
+
+def _etag_matches(etag: str) -> bool:
+    """
+    True if If-None-Match names `etag`, bare or with Compress' ":<encoding>"
+    suffix.  `*` is ignored: on a POST it must not turn into a 304.
+    """
+    return any(tag.partition(":")[0] == etag for tag in request.if_none_match)
+
 @app.post("/run")
 def run_notebook():
     try:
-        # ---------- 0. Size guard ----------
-        if request.content_length and request.content_length > MAX_NOTEBOOK_SIZE_MB * 1024 * 1024:
-            return jsonify({"error": "Notebook too large"}), 413
+        # ---------- 0. Size guard: enforced by BodyLimit before we get here ----------
 
         # ---------- 1. Unwrap + validate ----------
-        payload = request.get_json(force=True) or {}
-        
-        # unwrap n8n list / dict wrappers
-        if isinstance(payload, list):
-            if not payload:
-                return jsonify({"error": "Empty JSON array"}), 400
-            payload = payload[0]
-        nb_json = payload.get("notebook", payload)
-
-        # validate + convert to NotebookNode
-        if "cells" not in nb_json:
-            return jsonify({"error": "Invalid notebook JSON – missing 'cells'"}), 400
-            
-        try:
-            nb_node = nbformat.from_dict(nb_json)
-        except Exception as e:
-            return jsonify({"error": f"Notebook JSON invalid: {e}"}), 400
-
-        # kernel validation
-        kernelspec = (nb_node.metadata
-                            .get("kernelspec", {})
-                            .get("name", "python3"))
-        language = (nb_node.metadata
-                          .get("language_info", {})
-                          .get("name", "python"))
-        
-        if kernelspec not in ALLOWED_KERNELS:
-            return jsonify({"error": f"Kernel '{kernelspec}' not allowed"}), 400
-        if language not in {"python"}:
-            return jsonify({"error": f"Language '{language}' not supported"}), 400
+        payload = orjson.loads(request.get_data(cache=False)) or {}
+        nb_json, nb_node, kernelspec = _prepare_notebook(payload)
+
+        # ---------- 1.2. Serve identical payloads / unchanged code from cache ----------
+        lookup, store = _cache_directives()
+        cached, etag, cache_key, code_key = _lookup_cache(nb_json, nb_node, kernelspec, lookup)
+        if cached is not None:
+            headers = {"X-Cache": "HIT", "X-Cache-Key": code_key, "ETag": f'"{etag}"'}
+            if _etag_matches(etag):
+                return app.response_class(status=304, headers=headers)  # client already has them
+            return _results_response(cached, headers)
 
         # ---------- 1.5. Pre-check for missing imports ----------
+        _preflight(nb_node)
+
+        # ---------- 2. Execute ----------
         try:
-            missing_imports = _check_missing_imports(nb_node)
-            if missing_imports:
-                return jsonify({
-                    "error_type": "missing_dependencies",
-                    "missing_modules": missing_imports,
-                    "message": f"Missing required modules: {', '.join(missing_imports)}"
-                }), 422
-        except Exception:
-            # If import checking fails, continue anyway (don't block execution)
-            pass
+            _execute_notebook(nb_node, kernelspec)
+        except Exception as ex:
+            err_payload, status = _execution_error(nb_node, ex)
+            return jsonify(err_payload), status
 
-        # ---------- 2. Execute in temporary directory ----------
-        with tempfile.TemporaryDirectory() as tdir:
-            src_path = Path(tdir) / "input.ipynb"
-            dst_path = Path(tdir) / "output.ipynb"
-            
-            # write notebook to temp file
-            with src_path.open("w", encoding="utf-8") as f:
-                nbformat.write(nb_node, f)
+        # ---------- 3. Extract results from executed notebook ----------
+        try:
+            results = _extract_results(nb_node)
+            blob, etag = _cache_set(results, *((cache_key, code_key) if store else ()))
+            return _results_response(blob, {"X-Cache": "MISS" if lookup else "BYPASS",
+                                               "X-Cache-Key": code_key,
+                                               "ETag": f'"{etag}"'})  # 200 OK
+        except Exception as ex:
+            return jsonify({
+                "error_type": "result_extraction_error",
+                "message": str(ex)
+            }), 500
 
+    except Exception as exc:
+        return _gateway_error(exc)
+
+def _run_batch_item(payload, lookup: bool = True, store: bool = True) -> dict:
+    """
+    Run one notebook of a /run/batch request.  Failures are reported in its own
+    entry (`status: "error"` plus the HTTP status /run would have returned)
+    instead of failing the whole batch.
+    """
+    try:
+        nb_json, nb_node, kernelspec = _prepare_notebook(payload)
+        cached, _, cache_key, code_key = _lookup_cache(nb_json, nb_node, kernelspec, lookup)
+        if cached is not None:
+            return {"status": "ok", "cache": "HIT", "cache_key": code_key,
+                    "results": orjson.Fragment(cached)}
+
+        _preflight(nb_node)
+        try:
+            _execute_notebook(nb_node, kernelspec)
+        except Exception as ex:
+            err_payload, status = _execution_error(nb_node, ex)
+            return {"status": "error", "http_status": int(status), **err_payload}
+
+        try:
+            results = _extract_results(nb_node)
+        except Exception as ex:
+            return {"status": "error", "http_status": 500,
+                    "error_type": "result_extraction_error", "message": str(ex)}
+        blob, _ = _cache_set(results, *((cache_key, code_key) if store else ()))
+        return {"status": "ok", "cache": "MISS" if lookup else "BYPASS", "cache_key": code_key,
+                "results": orjson.Fragment(blob)}
+    except Exception as exc:
+        err_payload, status = _gateway_error_payload(exc)
+        return {"status": "error", "http_status": int(status), **err_payload}
+
+@app.post("/run/batch")
+def run_batch():
+    """Run several notebooks concurrently; entries come back in request order."""
+    try:
+        payload = orjson.loads(request.get_data(cache=False)) or {}
+        notebooks = payload.get("notebooks") if isinstance(payload, dict) else None
+        if not isinstance(notebooks, list) or not notebooks:
+            raise RequestError({"error": "Payload must contain a non-empty 'notebooks' list"})
+        if len(notebooks) > MAX_BATCH_SIZE:
+            raise RequestError({"error": f"At most {MAX_BATCH_SIZE} notebooks per batch"})
+
+        # Threads just wait on kernels: with a pool, its size is the real concurrency limit
+        workers = min(len(notebooks), KERNEL_POOL if KERNEL_POOL > 0 else os.cpu_count() or 1)
+        lookup, store = _cache_directives()  # worker threads have no request context
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+            entries = list(executor.map(lambda nb: _run_batch_item(nb, lookup, store), notebooks))
+        return jsonify({"results": entries})
+
+    except Exception as exc:
+        return _gateway_error(exc)
+
+class _StreamClosed(Exception):
+    """Raised from the cell hook to stop execution once an SSE client has gone."""
+
+def _sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + app.json.dumps_bytes(data) + b"\n\n"
+
+def _iter_execution_events(nb_node, kernelspec, cache_keys):
+    """
+    Run the notebook on a worker thread and yield SSE frames: one `cell` event
+    per executed code cell, then `results` or `error`, with comment pings every
+    SSE_KEEPALIVE seconds.  Closing the stream stops execution after the
+    current cell.
+    """
+    events = queue.Queue()
+    closed = threading.Event()
+
+    def on_cell_executed(cell, cell_index, **kwargs):
+        events.put(("cell", {
+            "index": cell_index,
+            "execution_count": cell.get("execution_count"),
+            "outputs": cell.get("outputs", []),
+        }))
+        if closed.is_set():
+            raise _StreamClosed()
+
+    def run():
+        try:
+            _execute_notebook(nb_node, kernelspec, on_cell_executed=on_cell_executed)
+            results = _extract_results(nb_node)
+            blob, _ = _cache_set(results, *cache_keys)
+            events.put(("results", {"results": orjson.Fragment(blob)}))
+        except _StreamClosed:
+            pass
+        except Exception as ex:
+            events.put(("error", _execution_error(nb_node, ex)[0]))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=run, name="sse-run", daemon=True).start()
+    try:
+        while True:
             try:
-                pm.execute_notebook(
-                    str(src_path),
-                    str(dst_path),
-                    kernel_name=kernelspec,
-                    progress_bar=False,
-                    log_output=False,
-                    start_timeout=60,  # Don't wait forever for kernel start
-                    execution_timeout=EXECUTION_TIMEOUT  # Max execution time
-                )
-            except pm.exceptions.PapermillExecutionError as ex:
-                # Decide which error flavour we want to expose
-                wrapped_is_module = ex.ename == "ModuleNotFoundError"
-                
-                # Handle traceback - can be string or list
-                tb = ex.traceback or []
-                if isinstance(tb, str):
-                    tb = tb.splitlines()
-                
-                err_payload = {
-                    "error_type": (
-                        "module_not_found" if wrapped_is_module else
-                        "papermill_execution_error"
-                    ),
-                    "cell": ex.exec_count,
-                    "cell_source": _cell_source_from_output(str(dst_path), ex.exec_count),
-                    "ename": ex.ename,
-                    "evalue": ex.evalue,
-                    "traceback": tb[-15:],  # Last 15 lines, whichever form it was
-                    "output_nb": str(dst_path) if dst_path.exists() else None  # Path to executed notebook
-                }
-                status = (http.HTTPStatus.BAD_REQUEST      # 400
-                          if wrapped_is_module else
-                          http.HTTPStatus.UNPROCESSABLE_ENTITY)  # 422
-                return jsonify(err_payload), status
-            except ModuleNotFoundError as ex:  # catches missing libs
-                return jsonify({
-                    "error_type": "module_not_found",
-                    "module": getattr(ex, 'name', 'unknown'),
-                    "message": str(ex)
-                }), http.HTTPStatus.BAD_REQUEST
-            except Exception as ex:
-                return jsonify({
-                    "error_type": "kernel_startup", 
-                    "message": str(ex)
-                }), 500
-
-            # ---------- 3. Extract results from executed notebook ----------
-            try:
-                results = _extract_results(str(dst_path))
-                return jsonify({"results": results}), 200  # Explicit 200 OK
-            except Exception as ex:
-                return jsonify({
-                    "error_type": "result_extraction_error",
-                    "message": str(ex),
-                    "output_nb": str(dst_path) if dst_path.exists() else None
-                }), 500
+                item = events.get(timeout=SSE_KEEPALIVE)
+            except queue.Empty:
+                yield b": keep-alive\n\n"
+                continue
+            if item is None:
+                return
+            yield _sse(*item)
+    finally:
+        closed.set()
 
+@app.post("/run/stream")
+def run_notebook_stream():
+    """Like /run, but streams each cell's outputs as Server-Sent Events."""
+    try:
+        payload = orjson.loads(request.get_data(cache=False)) or {}
+        nb_json, nb_node, kernelspec = _prepare_notebook(payload)
+        lookup, store = _cache_directives()
+        cached, _, cache_key, code_key = _lookup_cache(nb_json, nb_node, kernelspec, lookup)
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache-Key": code_key}
+        if cached is not None:
+            headers["X-Cache"] = "HIT"
+            frames = iter([_sse("results", {"results": orjson.Fragment(cached)})])
+        else:
+            _preflight(nb_node)
+            headers["X-Cache"] = "MISS" if lookup else "BYPASS"
+            frames = _iter_execution_events(nb_node, kernelspec,
+                                            (cache_key, code_key) if store else ())
+        return app.response_class(frames, mimetype="text/event-stream", headers=headers)
     except Exception as exc:
-        return jsonify({
-            "error_type": "gateway_error",
-            "error": str(exc),
-            "trace": traceback.format_exc().splitlines()[-10:]
-        }), 500
+        return _gateway_error(exc)
 
-def _cell_source_from_output(nb_path: str, cell_idx: int | None) -> str:
+def _cell_source_from_output(nb, cell_idx: int | None) -> str:
     """
     Return the literal source of the *cell that raised* inside an executed
     notebook.  We look for the first cell whose metadata.papermill["exception"]
     is True.  If that fails we fall back to `cell_idx – 1` (0-based).
     """
     try:
-        nb = nbformat.read(nb_path, as_version=4)
-
         # Primary: the papermill flag
         for c in nb.cells:
             if c.metadata.get("papermill", {}).get("exception"):
@@ -260,6 +1063,8 @@ def _cell_source_from_output(nb_path: str, cell_idx: int | None) -> str:
     except Exception:
         return "<error reading executed notebook>"
 
-if __name__ == '__main__':
+if __name__ == '__main__':  # dev server; production runs gunicorn -c gunicorn.conf.py gateway:app
     port = int(os.environ.get('GATEWAY_PORT', 5005))
+    if KERNEL_POOL > 0:
+        _kernel_pool("python3")  # pre-warm the default kernelspec
     app.run(host='0.0.0.0', port=port)
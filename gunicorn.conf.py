@@ -0,0 +1,22 @@
+"""
+Gunicorn settings for the Papermill Gateway (`gunicorn -c gunicorn.conf.py gateway:app`)
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('GATEWAY_PORT', 5005)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = 2
+timeout = int(os.environ.get("EXECUTION_TIMEOUT", 300)) + 30  # let notebook timeouts fire first
+preload_app = True  # import pandas/numpy/papermill once, share copy-on-write across workers
+# Worker heartbeat files (already unlinked after open) are touched on every loop; keep them
+# on tmpfs so the timestamps never hit a disk-backed /tmp
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def post_worker_init(worker):
+    """Warm each worker's own kernel pool; kernels must not be shared across forks."""
+    from gateway import KERNEL_POOL, _kernel_pool
+
+    if KERNEL_POOL > 0:
+        _kernel_pool("python3")